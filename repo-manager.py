@@ -6,39 +6,131 @@
 
 import sys
 import os
+import argparse
 import subprocess
 import re
 import json
-from typing import Optional, Any
+import hashlib
+import io
+import time
+import tempfile
+import struct
+import zlib
+import mmap
+import stat
+import concurrent.futures
+import threading
+import difflib
+from typing import Optional, Any, TextIO, Callable, Generic, TypeVar
 
 verbose = False
 default_config_path = '~/.config/repo-manager'
+default_durations_path = '~/.cache/repo-manager/scan-durations.json'
 
 def log(msg: str):
     if verbose:
-        print(msg)
+        # A single write, so lines logged from different threads don't get mixed up
+        print(msg + '\n', end='')
 
 def log_warning(msg: str):
     print('Warning: ' + msg)
 
+T = TypeVar('T')
+
+# Like functools.cached_property, which before Python 3.12 holds a single lock for all instances (so attributes of
+# different objects can't be computed in parallel). Computed values are stored in the instance's __dict__, which takes
+# priority over this descriptor.
+class cached_attribute(Generic[T]):
+    def __init__(self, func: Callable[[Any], T]) -> None:
+        self.func = func
+        self.name = func.__name__
+
+    def __get__(self, obj: Any, owner: Any = None) -> T:
+        value = self.func(obj)
+        obj.__dict__[self.name] = value
+        return value
+
 class Context:
+    # Totals that are saved in partial results and summed when merging them
+    counters = [
+        'git_repos', 'mercurial_repos', 'clean_repos', 'problem_repos',
+        'dirty_repos', 'unsynced_repos', 'no_remote_repos', 'subprocesses', 'fast_status_repos',
+    ]
+
     def __init__(self):
+        # Root of the scan and (index, count) of the shard being scanned, if only part of it is being scanned
+        self.root: Optional[str] = None
+        self.shard: Optional[tuple[int, int]] = None
+        # If Git repos that are known to be clean from their index should skip `git status`
+        self.fast_status = False
+        self.fast_status_repos = 0
+        # GitRepo attributes to compute while scanning, or None to only compute them when they're used
+        self.git_fields: Optional[list[str]] = None
+        # If set, Git repos are added to this list instead of being probed as they're found (see probe_git_repos())
+        self.git_queue: Optional[list[Any]] = None
+        # Wall time taken to probe the queued Git repos and the best possible time with the same number of jobs
+        self.makespan_seconds: Optional[float] = None
+        self.ideal_makespan_seconds: Optional[float] = None
+        # Held when updating the context from multiple threads
+        self.lock = threading.Lock()
         self.git_repos = 0
         self.mercurial_repos = 0
         self.clean_repos = 0
         self.problem_repos = 0
+        self.dirty_repos = 0
+        self.unsynced_repos = 0
+        self.no_remote_repos = 0
+        self.subprocesses = 0
+        # Seconds spent in subprocesses, keyed by command (such as 'git status')
+        self.phase_seconds: dict[str, float] = {}
+        # Data shared between all worktrees of a Git repo, keyed by common Git directory
+        self.git_remotes: dict[str, concurrent.futures.Future[dict[str, str]]] = {}
+        self.git_commits_on_remote: dict[tuple[str, str], concurrent.futures.Future[bool]] = {}
+
+    # Computes the value for key once, even if several threads ask for it at the same time
+    def shared(self, cache: dict[Any, concurrent.futures.Future[T]], key: Any, compute: Callable[[], T]) -> T:
+        with self.lock:
+            future = cache.get(key)
+            computing = future is None
+            if future is None:
+                future = concurrent.futures.Future()
+                cache[key] = future
+        if computing:
+            try:
+                future.set_result(compute())
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+    def to_json(self) -> dict[str, Any]:
+        result: dict[str, Any] = {name: getattr(self, name) for name in Context.counters}
+        result['phase_seconds'] = self.phase_seconds
+        return result
+
+    def add_json(self, data: dict[str, Any]):
+        for name in Context.counters:
+            setattr(self, name, getattr(self, name) + data[name])
+        for phase, seconds in data['phase_seconds'].items():
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
 
 class Run:
     def __init__(self,
         arg_list: list[str],
         path: Optional[str] = None,
         passthrough=False,
-        raise_on_fail=False
+        raise_on_fail=False,
+        ctx: Optional[Context] = None
     ) -> None:
         log('Running `' + ' '.join(arg_list) + '`')
         io = None if passthrough else subprocess.PIPE
+        start = time.monotonic()
         p = subprocess.Popen(arg_list, cwd=path, stdout=io, stderr=io)
         stdout, stderr = p.communicate(None)
+        if ctx is not None:
+            phase = ' '.join(arg_list[:2])
+            with ctx.lock:
+                ctx.subprocesses += 1
+                ctx.phase_seconds[phase] = ctx.phase_seconds.get(phase, 0.0) + time.monotonic() - start
         self.stdout = stdout.decode('utf-8') if stdout != None else ''
         self.stderr = stderr.decode('utf-8') if stderr != None else ''
         self.exit_code = p.returncode
@@ -60,40 +152,530 @@ def style_if(txt: str, s: str, cond: bool) -> str:
         return txt
 
 class MercurialRepo:
+    json_type = 'mercurial'
+
     def __init__(self, base: str, ctx: Context):
         assert os.path.isdir(os.path.join(base, '.hg'))
         assert not os.path.islink(base)
         ctx.mercurial_repos += 1
         log('Scanned Mercurial repo at ' + base)
 
+    def to_json(self) -> dict[str, Any]:
+        return {'type': self.json_type, **vars(self)}
+
     def __str__(self, color: bool = False):
         return style_if('Mercurial repo', '1;35', color)
 
+# Returns the Git directory and common Git directory of the repo at base, or None if it is not a Git repo. Linked
+# worktrees and submodules have a .git file pointing to their Git directory, and a linked worktree's Git directory
+# has a commondir file pointing to the Git directory it shares with the main worktree.
+def find_git_dirs(base: str) -> Optional[tuple[str, str]]:
+    dot_git = os.path.join(base, '.git')
+    if os.path.isdir(dot_git):
+        git_dir = dot_git
+    elif os.path.isfile(dot_git):
+        try:
+            with open(dot_git, 'r') as f:
+                match = re.match(r'gitdir: (.*)', f.read())
+        except (OSError, UnicodeDecodeError):
+            return None
+        if not match:
+            return None
+        git_dir = os.path.normpath(os.path.join(base, match.group(1).strip()))
+        if not os.path.isdir(git_dir):
+            return None
+    else:
+        return None
+    common_dir = git_dir
+    commondir_path = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir_path):
+        try:
+            with open(commondir_path, 'r') as f:
+                common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+        except (OSError, UnicodeDecodeError):
+            return None
+    return os.path.realpath(git_dir), os.path.realpath(common_dir)
+
+# Submodules keep their Git directory in the modules directory of their superproject's (possibly nested) Git directory
+def is_submodule_git_dir(git_dir: str) -> bool:
+    parent = os.path.dirname(git_dir)
+    while parent != os.path.dirname(parent):
+        if os.path.basename(parent) == 'modules' and os.path.isfile(os.path.join(os.path.dirname(parent), 'HEAD')):
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+# Fast status checks that read Git's on-disk data directly instead of spawning `git status`. They only ever claim a
+# repo is clean when they're sure, and return None or False for anything they don't understand (sparse and split
+# indexes, conflicts, submodules, racily clean files, untracked or ignored files, etc) so the caller can fall back to
+# asking git.
+
+def parse_git_config_value(raw: str) -> Optional[str]:
+    result = ''
+    pending_space = ''
+    quoted = False
+    i = 0
+    while i < len(raw):
+        c = raw[i]
+        if c == '\\':
+            i += 1
+            if i >= len(raw) or raw[i] not in 'ntb"\\':
+                return None
+            result += pending_space + {'n': '\n', 't': '\t', 'b': '\b'}.get(raw[i], raw[i])
+            pending_space = ''
+        elif c == '"':
+            quoted = not quoted
+        elif c in '#;' and not quoted:
+            break
+        elif c.isspace() and not quoted:
+            pending_space += c
+        else:
+            result += pending_space + c
+            pending_space = ''
+        i += 1
+    return None if quoted else result
+
+# Returns a dict of lowercase section.subsection.key names to values, where later files override earlier ones, or
+# None if any of the files use syntax that isn't understood
+def read_git_config(paths: list[str]) -> Optional[dict[str, str]]:
+    config: dict[str, str] = {}
+    for path in paths:
+        try:
+            with open(path, 'r') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            continue
+        except (OSError, UnicodeDecodeError):
+            return None
+        section = None
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            match = re.fullmatch(r'\[([\w.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\]\s*(?:[#;].*)?', line)
+            if match:
+                section = match.group(1).lower()
+                if match.group(2) is not None:
+                    section += '.' + re.sub(r'\\(.)', r'\1', match.group(2))
+                continue
+            match = re.fullmatch(r'([A-Za-z][\w-]*)\s*(?:=(.*))?', line)
+            if not match or section is None:
+                return None
+            value = parse_git_config_value(match.group(2).lstrip()) if match.group(2) is not None else 'true'
+            if value is None:
+                return None
+            config[section + '.' + match.group(1).lower()] = value
+    return config
+
+def git_config_bool(config: dict[str, str], key: str, default: bool) -> Optional[bool]:
+    value = config.get(key)
+    if value is None:
+        return default
+    if value.lower() in ('true', 'yes', 'on', '1'):
+        return True
+    if value.lower() in ('false', 'no', 'off', '0', ''):
+        return False
+    return None
+
+def load_git_config(git_dir: str, common_dir: str) -> Optional[dict[str, str]]:
+    # These change which config, index or working tree `git status` uses
+    if any(name in os.environ for name in [
+        'GIT_CONFIG_PARAMETERS', 'GIT_CONFIG_COUNT', 'GIT_CONFIG_GLOBAL', 'GIT_CONFIG_SYSTEM', 'GIT_CONFIG_NOSYSTEM',
+        'GIT_DIR', 'GIT_WORK_TREE', 'GIT_INDEX_FILE',
+    ]):
+        return None
+    xdg_config = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    paths = [
+        '/etc/gitconfig',
+        os.path.join(xdg_config, 'git', 'config'),
+        os.path.expanduser('~/.gitconfig'),
+        os.path.join(common_dir, 'config'),
+        os.path.join(git_dir, 'config.worktree'),
+    ]
+    config = read_git_config(paths)
+    if config is None or any(key.startswith('include.') or key.startswith('includeif.') for key in config):
+        return None
+    return config
+
+def resolve_git_ref(git_dir: str, common_dir: str, ref: str) -> Optional[str]:
+    for _ in range(5):
+        # HEAD lives in the worktree's Git directory, everything under refs/ in the common one
+        try:
+            with open(os.path.join(common_dir if ref.startswith('refs/') else git_dir, ref), 'r') as f:
+                content = f.read().strip()
+        except FileNotFoundError:
+            content = ''
+            try:
+                with open(os.path.join(common_dir, 'packed-refs'), 'r') as f:
+                    for line in f:
+                        parts = line.split()
+                        if len(parts) == 2 and parts[1] == ref:
+                            content = parts[0]
+                            break
+            except FileNotFoundError:
+                pass
+        except OSError:
+            return None
+        if content.startswith('ref: '):
+            ref = content[5:].strip()
+        elif re.fullmatch(r'[0-9a-f]{40}', content):
+            return content
+        else:
+            return None
+    return None
+
+def read_packed_commit(objects_dir: str, sha: str) -> Optional[bytes]:
+    binary = bytes.fromhex(sha)
+    pack_dir = os.path.join(objects_dir, 'pack')
+    for name in sorted(os.listdir(pack_dir)) if os.path.isdir(pack_dir) else []:
+        if not name.endswith('.idx'):
+            continue
+        # See Documentation/gitformat-pack.txt, only version 2 pack indexes are supported
+        with open(os.path.join(pack_dir, name), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as idx:
+            if idx[:8] != b'\xfftOc\x00\x00\x00\x02':
+                return None
+            first = struct.unpack_from('>I', idx, 8 + (binary[0] - 1) * 4)[0] if binary[0] else 0
+            last, count = struct.unpack_from('>I', idx, 8 + binary[0] * 4)[0], struct.unpack_from('>I', idx, 8 + 255 * 4)[0]
+            shas = 8 + 256 * 4
+            while first < last:
+                mid = (first + last) // 2
+                if idx[shas + mid * 20:shas + mid * 20 + 20] < binary:
+                    first = mid + 1
+                else:
+                    last = mid
+            if idx[shas + first * 20:shas + first * 20 + 20] != binary:
+                continue
+            offsets = shas + count * 24
+            offset = struct.unpack_from('>I', idx, offsets + first * 4)[0]
+            if offset & 0x80000000:
+                offset = struct.unpack_from('>Q', idx, offsets + count * 4 + (offset & 0x7fffffff) * 8)[0]
+        with open(os.path.join(pack_dir, name[:-4] + '.pack'), 'rb') as f:
+            f.seek(offset)
+            c = f.read(1)[0]
+            # Deltified commits are rare, so aren't worth resolving here
+            if (c >> 4) & 7 != 1:
+                return None
+            size = c & 15
+            shift = 4
+            while c & 0x80:
+                c = f.read(1)[0]
+                size |= (c & 0x7f) << shift
+                shift += 7
+            decompressor = zlib.decompressobj()
+            result = b''
+            while not decompressor.eof and len(result) < size:
+                chunk = f.read(4096)
+                if not chunk:
+                    return None
+                result += decompressor.decompress(chunk)
+            return result[:size]
+    return None
+
+def read_commit_tree(common_dir: str, sha: str) -> Optional[str]:
+    objects_dir = os.path.join(common_dir, 'objects')
+    try:
+        try:
+            with open(os.path.join(objects_dir, sha[:2], sha[2:]), 'rb') as f:
+                header, _, body = zlib.decompress(f.read()).partition(b'\0')
+            if not header.startswith(b'commit '):
+                return None
+        except FileNotFoundError:
+            packed = read_packed_commit(objects_dir, sha)
+            if packed is None:
+                return None
+            body = packed
+    except (OSError, ValueError, IndexError, struct.error, zlib.error):
+        return None
+    match = re.match(rb'tree ([0-9a-f]{40})\n', body)
+    return match.group(1).decode('ascii') if match else None
+
+class GitIndex:
+    def __init__(self, path: str):
+        # See Documentation/gitformat-index.txt. Raises ValueError for anything the fast status check can't handle.
+        with open(path, 'rb') as f:
+            data = f.read()
+            self.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+        if len(data) < 32 or data[:4] != b'DIRC':
+            raise ValueError('not an index file')
+        version, count = struct.unpack_from('>II', data, 4)
+        if version not in (2, 3, 4):
+            raise ValueError('unsupported index version ' + str(version))
+        # (path, ctime seconds, ctime nanoseconds, mtime seconds, mtime nanoseconds, inode, mode, size)
+        self.entries: list[tuple[bytes, int, int, int, int, int, int, int]] = []
+        self.tree: Optional[str] = None
+        pos = 12
+        name = b''
+        for _ in range(count):
+            start = pos
+            ctime_s, ctime_ns, mtime_s, mtime_ns, _dev, ino, mode, _uid, _gid, size = struct.unpack_from('>10I', data, pos)
+            flags = struct.unpack_from('>H', data, pos + 60)[0]
+            pos += 62
+            if flags & 0xb000:
+                raise ValueError('entry is assumed valid or has a merge conflict')
+            if flags & 0x4000:
+                if struct.unpack_from('>H', data, pos)[0]:
+                    raise ValueError('entry is skip-worktree or intent-to-add')
+                pos += 2
+            if version == 4:
+                strip = data[pos] & 0x7f
+                while data[pos] & 0x80:
+                    pos += 1
+                    strip = ((strip + 1) << 7) | (data[pos] & 0x7f)
+                pos += 1
+                end = data.index(b'\0', pos)
+                name = name[:len(name) - strip] + data[pos:end]
+                pos = end + 1
+            else:
+                end = data.index(b'\0', pos)
+                name = data[pos:end]
+                pos = start + ((end - start + 8) & ~7)
+            if mode >> 12 not in (0o10, 0o12):
+                raise ValueError('entry is a submodule or sparse directory')
+            self.entries.append((name, ctime_s, ctime_ns, mtime_s, mtime_ns, ino, mode, size))
+        while pos < len(data) - 20:
+            signature = data[pos:pos + 4]
+            size = struct.unpack_from('>I', data, pos + 4)[0]
+            body = data[pos + 8:pos + 8 + size]
+            pos += 8 + size
+            if signature == b'TREE' and body[:1] == b'\0':
+                entry_count = int(body[1:body.index(b'\n')].split(b' ')[0])
+                if entry_count >= 0:
+                    self.tree = body[body.index(b'\n') + 1:][:20].hex()
+            elif signature[:1].islower():
+                # Extensions starting with a lowercase letter (split and sparse indexes) must be understood
+                raise ValueError('unsupported index extension ' + repr(signature))
+
+def index_entries_unchanged(base: bytes, entries: list[tuple[bytes, int, int, int, int, int, int, int]]) -> bool:
+    for name, ctime_s, ctime_ns, mtime_s, mtime_ns, ino, mode, size in entries:
+        try:
+            st = os.lstat(os.path.join(base, name))
+        except OSError:
+            return False
+        if (
+            st.st_mtime_ns // 1000000000 & 0xffffffff != mtime_s or st.st_mtime_ns % 1000000000 != mtime_ns or
+            st.st_ctime_ns // 1000000000 & 0xffffffff != ctime_s or st.st_ctime_ns % 1000000000 != ctime_ns or
+            st.st_ino & 0xffffffff != ino or st.st_size & 0xffffffff != size
+        ):
+            return False
+        if mode >> 12 == 0o12:
+            if not stat.S_ISLNK(st.st_mode):
+                return False
+        elif not stat.S_ISREG(st.st_mode) or bool(st.st_mode & 0o100) != (mode & 0o777 == 0o755):
+            return False
+    return True
+
+def has_untracked_files(base: bytes, rel: bytes, tracked: set[bytes], tracked_dirs: set[bytes]) -> bool:
+    # Untracked files might be ignored, but gitignore rules aren't implemented here so any of them count
+    with os.scandir(os.path.join(base, rel) if rel else base) as it:
+        for entry in it:
+            path = rel + b'/' + entry.name if rel else entry.name
+            if path == b'.git':
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if path not in tracked_dirs or has_untracked_files(base, path, tracked, tracked_dirs):
+                    return True
+            elif path not in tracked:
+                return True
+    return False
+
+# Returns True if the working tree and index are known to match HEAD without running `git status`
+def index_says_clean(base: str, git_dir: str, common_dir: str, config: dict[str, str]) -> bool:
+    if (
+        any(git_config_bool(config, key, False) != False for key in [
+            'core.bare', 'core.sparsecheckout', 'core.splitindex', 'index.sparse', 'core.ignorecase', 'core.fsmonitor',
+        ]) or
+        config.get('core.worktree') is not None or
+        config.get('extensions.objectformat', 'sha1').lower() != 'sha1' or
+        config.get('extensions.refstorage', 'files').lower() != 'files' or
+        # When untracked files are hidden `git status` doesn't say the working tree is clean, so GitRepo needs to see
+        # its output
+        config.get('status.showuntrackedfiles', 'normal').lower() not in ('normal', 'all')
+    ):
+        log('Git config of ' + base + ' is not supported by fast status')
+        return False
+    head = resolve_git_ref(git_dir, common_dir, 'HEAD')
+    head_tree = read_commit_tree(common_dir, head) if head is not None else None
+    try:
+        index = GitIndex(os.path.join(git_dir, 'index'))
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        log('Can not use fast status for ' + base + ': ' + str(e))
+        return False
+    # The index's cached tree matching HEAD's tree means nothing is staged
+    if head_tree is None or index.tree != head_tree:
+        log('Index of ' + base + ' may not match HEAD')
+        return False
+    # Files modified in the same instant the index was written are racily clean, and need their contents checked
+    if any(e[3] * 1000000000 + e[4] >= index.mtime_ns for e in index.entries):
+        log('Index of ' + base + ' has racily clean entries')
+        return False
+    base_bytes = os.fsencode(base)
+    entries = index.entries
+    if len(entries) < 1000:
+        unchanged = index_entries_unchanged(base_bytes, entries)
+    else:
+        # lstat releases the GIL, so this speeds things up considerably on cold caches and network filesystems
+        chunk_size = 256
+        chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            unchanged = all(pool.map(lambda chunk: index_entries_unchanged(base_bytes, chunk), chunks))
+    if not unchanged:
+        log('Files in ' + base + ' may have changed')
+        return False
+    tracked = set(e[0] for e in entries)
+    tracked_dirs = set()
+    for path in tracked:
+        while b'/' in path:
+            path = path.rsplit(b'/', 1)[0]
+            if path in tracked_dirs:
+                break
+            tracked_dirs.add(path)
+    if has_untracked_files(base_bytes, b'', tracked, tracked_dirs):
+        log(base + ' may have untracked files')
+        return False
+    return True
+
+# Equivalent to `git status` saying the branch is up to date with its remote upstream
+def head_matches_upstream(git_dir: str, common_dir: str, config: dict[str, str]) -> bool:
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+            head_ref = f.read().strip()
+    except OSError:
+        return False
+    if not head_ref.startswith('ref: refs/heads/'):
+        return False
+    branch = head_ref[len('ref: refs/heads/'):]
+    remote = config.get('branch.' + branch + '.remote')
+    merge = config.get('branch.' + branch + '.merge')
+    if not remote or remote == '.' or not merge or not merge.startswith('refs/heads/'):
+        return False
+    if config.get('remote.' + remote + '.fetch') != '+refs/heads/*:refs/remotes/' + remote + '/*':
+        return False
+    head = resolve_git_ref(git_dir, common_dir, 'HEAD')
+    upstream = resolve_git_ref(git_dir, common_dir, 'refs/remotes/' + remote + '/' + merge[len('refs/heads/'):])
+    return head is not None and head == upstream
+
 class GitRepo:
+    json_type = 'git'
+
     def __init__(self, base: str, ctx: Context):
-        assert os.path.isdir(os.path.join(base, '.git'))
+        dirs = find_git_dirs(base)
+        assert dirs is not None
         assert not os.path.islink(base)
         self.path = base
-        log('Scanning Git repo at ' + base + '...')
-        status_output = Run(['git', 'status'], path=base, raise_on_fail=True).stdout
-        remotes_output = Run(['git', 'remote', '-v'], path=base, raise_on_fail=True).stdout
-        self.working_tree_clean = bool(re.findall(r'nothing to commit, working tree clean', status_output))
-        self.remotes = {}
-        for match in re.finditer(r'([^\s]+)\s+([^\s]+).*[$\n]', remotes_output):
-            self.remotes[match.group(1)] = match.group(2)
-        self.synced_with_remote = bool(re.findall(r'Your branch is up to date with \'.*/.*\'\.', status_output))
-        if self.working_tree_clean and self.remotes and not self.synced_with_remote:
-            log('Checking if last commit is on remote')
-            last_commit = Run(['git', 'rev-parse', 'HEAD'], path=base, raise_on_fail=True).stdout.strip()
-            remotes_with_last_commit_result = Run(['git', 'branch', '-r', '--contains', last_commit], path=base, raise_on_fail=False);
-            if remotes_with_last_commit_result.exit_code == 0 and remotes_with_last_commit_result.stdout.strip() != '':
-                self.synced_with_remote = True
+        self.git_dir, self.common_dir = dirs
+        if self.git_dir != self.common_dir:
+            self.kind = 'worktree'
+        elif os.path.isfile(os.path.join(base, '.git')) and is_submodule_git_dir(self.git_dir):
+            self.kind = 'submodule'
+        else:
+            self.kind = 'repo'
+        self._ctx = ctx
+        if ctx.git_fields is None:
+            ctx.git_repos += 1
+            return
+        if ctx.git_queue is not None:
+            ctx.git_queue.append(self)
+            return
+        self.probe()
+        self.count()
+
+    # Computes the attributes the scan needs
+    def probe(self) -> None:
+        log('Scanning Git ' + self.kind + ' at ' + self.path + '...')
+        for field in self._ctx.git_fields or []:
+            getattr(self, field)
+        self.is_problem()
+        log('... Scanned ' + self.path + ' done')
+
+    # Adds the repo to the context's totals, once it has been probed
+    def count(self) -> None:
+        ctx = self._ctx
         ctx.git_repos += 1
         if self.is_problem():
             ctx.problem_repos += 1
         else:
             ctx.clean_repos += 1
-        log('... Scanned ' + base + ' done')
+        # Only count what was needed to show the results, further probes would be wasted
+        known = vars(self)
+        if 'working_tree_clean' in known and not self.working_tree_clean:
+            ctx.dirty_repos += 1
+        if 'remotes' in known and not self.remotes:
+            ctx.no_remote_repos += 1
+        if 'synced_with_remote' in known and not self.synced_with_remote:
+            ctx.unsynced_repos += 1
+
+    # The attributes below are computed when first used, so commands only pay for the probes they need
+
+    @cached_attribute
+    def _config(self) -> Optional[dict[str, str]]:
+        return load_git_config(self.git_dir, self.common_dir) if self._ctx.fast_status else None
+
+    # If the working tree is clean and if git status says the branch is up to date with its upstream
+    @cached_attribute
+    def _status(self) -> tuple[bool, bool]:
+        config = self._config
+        if config is not None and index_says_clean(self.path, self.git_dir, self.common_dir, config):
+            log('Index shows ' + self.path + ' is clean, skipping git status')
+            with self._ctx.lock:
+                self._ctx.fast_status_repos += 1
+            return True, head_matches_upstream(self.git_dir, self.common_dir, config)
+        status_output = Run(['git', 'status'], path=self.path, raise_on_fail=True, ctx=self._ctx).stdout
+        return (
+            bool(re.findall(r'nothing to commit, working tree clean', status_output)),
+            bool(re.findall(r'Your branch is up to date with \'.*/.*\'\.', status_output)))
+
+    @cached_attribute
+    def working_tree_clean(self) -> bool:
+        return self._status[0]
+
+    @cached_attribute
+    def synced_with_remote(self) -> bool:
+        if self._status[1]:
+            return True
+        return self.working_tree_clean and bool(self.remotes) and self._last_commit_on_remote(self._ctx)
+
+    # Remotes are stored in the common Git directory, so are only loaded once for all worktrees
+    @cached_attribute
+    def remotes(self) -> dict[str, str]:
+        return self._ctx.shared(self._ctx.git_remotes, self.common_dir, self._load_remotes)
+
+    def _load_remotes(self) -> dict[str, str]:
+        config = self._config
+        remotes = {}
+        # URL rewriting is left to git
+        if config is not None and not any(key.endswith('insteadof') for key in config):
+            for key, value in config.items():
+                match = re.fullmatch(r'remote\.(.+)\.url', key)
+                if match:
+                    # Like `git remote -v`, which lists the push URL last
+                    remotes[match.group(1)] = config.get('remote.' + match.group(1) + '.pushurl', value)
+            return remotes
+        remotes_output = Run(['git', 'remote', '-v'], path=self.path, raise_on_fail=True, ctx=self._ctx).stdout
+        for match in re.finditer(r'([^\s]+)\s+([^\s]+).*[$\n]', remotes_output):
+            remotes[match.group(1)] = match.group(2)
+        return remotes
+
+    def _last_commit_on_remote(self, ctx: Context) -> bool:
+        log('Checking if last commit is on remote')
+        last_commit = Run(['git', 'rev-parse', 'HEAD'], path=self.path, raise_on_fail=True, ctx=ctx).stdout.strip()
+        def on_remote() -> bool:
+            remotes_with_last_commit_result = Run(['git', 'branch', '-r', '--contains', last_commit], path=self.path, raise_on_fail=False, ctx=ctx);
+            return (
+                remotes_with_last_commit_result.exit_code == 0 and
+                remotes_with_last_commit_result.stdout.strip() != '')
+        return ctx.shared(ctx.git_commits_on_remote, (self.common_dir, last_commit), on_remote)
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'type': self.json_type,
+            'path': self.path,
+            'git_dir': self.git_dir,
+            'common_dir': self.common_dir,
+            'kind': self.kind,
+            'working_tree_clean': self.working_tree_clean,
+            'remotes': self.remotes,
+            'synced_with_remote': self.synced_with_remote,
+        }
 
     def default_local_branch(self) -> str:
         all_local_branches = Run(
@@ -124,9 +706,9 @@ class GitRepo:
         if not self.synced_with_remote:
             result.append('Not synced with remote')
         if self.is_problem():
-            result = ['Git repo'] + result
+            result = ['Git ' + self.kind] + result
         else:
-            result = ['Clean Git repo'] + result
+            result = ['Clean Git ' + self.kind] + result
         if color:
             s = style('1;31') if self.is_problem() else style('1;32')
             for i in range(len(result)):
@@ -134,6 +716,8 @@ class GitRepo:
         return '\n'.join(result)
 
 class Link:
+    json_type = 'link'
+
     def __init__(self, base: str, ctx: Context):
         base = os.path.normpath(base)
         assert os.path.islink(base)
@@ -141,81 +725,180 @@ class Link:
         assert self.target != base
         log('Scanned link at ' + base)
 
+    def to_json(self) -> dict[str, Any]:
+        return {'type': self.json_type, **vars(self)}
+
     def __str__(self, color=False) -> str:
         return style_if('Link to ' + self.target, '1;36', color)
 
+def is_repo(base: str) -> bool:
+    return (
+        not os.path.islink(base) and
+        (find_git_dirs(base) is not None or os.path.isdir(os.path.join(base, '.hg'))))
+
+def shard_of(base: str, root: str, shard_count: int) -> int:
+    # Hashes the path relative to the root so all machines agree on the shard even if the root is mounted elsewhere
+    digest = hashlib.sha1(os.path.relpath(base, root).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count + 1
+
+class OtherShardRepo:
+    json_type = 'other_shard'
+
+    def __init__(self, base: str, ctx: Context):
+        assert ctx.shard is not None and ctx.root is not None
+        assert is_repo(base)
+        index, count = ctx.shard
+        assert shard_of(base, ctx.root, count) != index
+        log('Skipped repo at ' + base + ' because it is in another shard')
+
+    def to_json(self) -> dict[str, Any]:
+        return {'type': self.json_type, **vars(self)}
+
+    def __str__(self, color=False) -> str:
+        return style_if('Repo in another shard', '1;33', color)
+
 class Directory:
+    json_type = 'directory'
+
     def __init__(self, base: str, ctx: Context):
         log('Scanning directory at ' + base)
         assert not os.path.islink(base)
         assert os.path.isdir(base)
         log('Scanning directory at ' + base + '...')
-        self.contents = {}
+        self.contents: dict[str, Any] = {}
         self.contains_code_repo = False
         for sub in os.listdir(base):
             if not sub.startswith('.'): # ignore hidden files
-                 scanned = scan_path(os.path.join(base, sub), ctx)
-                 if (isinstance(scanned, GitRepo) or
-                     isinstance(scanned, MercurialRepo) or
-                        (isinstance(scanned, Directory) and
-                        scanned.contains_code_repo)):
-                    self.contains_code_repo = True
-                 self.contents[sub] = scanned
+                self.add(sub, scan_path(os.path.join(base, sub), ctx))
         log('... Scanning ' + base + ' done')
 
+    def add(self, name: str, scanned: Any):
+        if (isinstance(scanned, GitRepo) or
+            isinstance(scanned, MercurialRepo) or
+            isinstance(scanned, OtherShardRepo) or
+                (isinstance(scanned, Directory) and
+                scanned.contains_code_repo)):
+            self.contains_code_repo = True
+        self.contents[name] = scanned
+
+    # Computed when first used, since Git repos may not have been probed yet when they're added
+    @cached_attribute
+    def contains_problem_repo(self) -> bool:
+        return any(is_problem(scanned) for scanned in self.contents.values())
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            'type': Directory.json_type,
+            'contents': {name: scanned.to_json() for name, scanned in self.contents.items()},
+        }
+
     def __str__(self, color=False) -> str:
+        out = io.StringIO()
+        self.write(out, color=color)
+        return out.getvalue()
+
+    # Writes the tree directly to out in a single pass. prefix is written at the start of every line after the first
+    # and ends up as the indentation of nested directories. If problems_only is set, subtrees without problem repos
+    # are pruned.
+    def write(self, out: TextIO, color=False, prefix='', problems_only=False) -> None:
         if not self.contains_code_repo:
-            result = 'Directory without repos'
-            if color:
-                result = style('1;34') + result + style(None)
-            return result
+            out.write(style_if('Directory without repos', '1;34', color))
+            return
+        items = [
+            (key, val) for key, val in self.contents.items()
+            if not problems_only or is_problem(val)
+        ]
+        if not items:
+            out.write(style_if('No dirty repos', '1;32', color))
+            return
         # Directories with contents always start with a newline
-        result = '\n'
-        items = list(self.contents.items())
-        for i in range(len(items)):
-            key, val = items[i]
+        for i, (key, val) in enumerate(items):
             indent_a = ' ├╴'
             indent_b = ' │ '
-            if i != 0:
-                result += '\n'
             if i == len(items) - 1:
                 indent_a = ' ╰╴'
                 indent_b = '   '
-            indent_b = style_if(indent_b, '37', color)
-            v = val.__str__(color=color)
+            out.write('\n' + prefix + style_if(indent_a, '37', color) + key)
+            sub_prefix = prefix + style_if(indent_b, '37', color)
             if isinstance(val, Directory):
-                v = ': ' + v.replace('\n', '\n' + indent_b)
-            else:
-                indent_b += ' ' * len(key)
-                if v.find('\n') == -1:
-                    v = ': ' + v
-                elif len(v) > 1:
-                    v = v.split('\n')
-                    v = ('\n' + indent_b).join(
-                        [style_if('⎧ ' + v[0],  '0', color)] +
-                        [style_if('⎪ ' + i,     '0', color) for i in v[1:-1]] +
-                        [style_if('⎩ ' + v[-1], '0', color)])
-            indent_a = style_if(indent_a, '37', color)
-            result += indent_a + key + v
-        return result
+                out.write(': ')
+                val.write(out, color=color, prefix=sub_prefix, problems_only=problems_only)
+                continue
+            lines = val.__str__(color=color).split('\n')
+            if len(lines) == 1:
+                out.write(': ' + lines[0])
+                continue
+            sub_prefix += ' ' * len(key)
+            out.write(style_if('⎧ ' + lines[0], '0', color))
+            for line in lines[1:-1]:
+                out.write('\n' + sub_prefix + style_if('⎪ ' + line, '0', color))
+            out.write('\n' + sub_prefix + style_if('⎩ ' + lines[-1], '0', color))
 
 class File:
+    json_type = 'file'
+
     def __init__(self, base: str, ctx: Context):
         log('Scanning file at ' + base)
         assert not os.path.islink(base)
         assert os.path.isfile(base)
 
+    def to_json(self) -> dict[str, Any]:
+        return {'type': self.json_type, **vars(self)}
+
     def __str__(self, color=False) -> str:
         return style_if('File', '1;34', color)
 
-def scan_path(base: str, ctx: Context):
-    for i in [Link, GitRepo, MercurialRepo, Directory, File]:
+def is_problem(scanned) -> bool:
+    if isinstance(scanned, GitRepo):
+        return scanned.is_problem()
+    if isinstance(scanned, Directory):
+        return scanned.contains_problem_repo
+    return False
+
+def scan_path(base: str, ctx: Context, types: Optional[list[Any]] = None):
+    for i in types or [Link, OtherShardRepo, GitRepo, MercurialRepo, Directory, File]:
         try:
             return i(base, ctx)
         except AssertionError:
             pass
     raise RuntimeError('Failed to scan ' + base)
 
+def scanned_from_json(data: dict[str, Any]) -> Any:
+    data = dict(data)
+    json_type = data.pop('type')
+    if json_type == Directory.json_type:
+        directory = Directory.__new__(Directory)
+        directory.contents = {}
+        directory.contains_code_repo = False
+        for name, sub in data['contents'].items():
+            directory.add(name, scanned_from_json(sub))
+        return directory
+    leaf_types: list[Any] = [Link, OtherShardRepo, GitRepo, MercurialRepo, File]
+    for i in leaf_types:
+        if i.json_type == json_type:
+            scanned = i.__new__(i)
+            vars(scanned).update(data)
+            return scanned
+    raise RuntimeError('Unknown scan result type ' + json_type)
+
+# Combines results of scanning different shards of the same tree
+def merge_scanned(a: Any, b: Any) -> Any:
+    if isinstance(a, OtherShardRepo):
+        return b
+    if isinstance(b, OtherShardRepo):
+        return a
+    if isinstance(a, Directory) and isinstance(b, Directory):
+        result = Directory.__new__(Directory)
+        result.contents = {}
+        result.contains_code_repo = False
+        for name, scanned in a.contents.items():
+            result.add(name, merge_scanned(scanned, b.contents[name]) if name in b.contents else scanned)
+        for name, scanned in b.contents.items():
+            if name not in a.contents:
+                result.add(name, scanned)
+        return result
+    return a
+
 def get_directory_from_args(args, name: str) -> str:
     path = '.'
     if hasattr(args, name) and getattr(args, name) is not None:
@@ -225,19 +908,269 @@ def get_directory_from_args(args, name: str) -> str:
         raise RuntimeError(path + ' is not a directory')
     return path;
 
-def scan_command(args) -> None:
-    directory = get_directory_from_args(args, 'directory')
-    ctx = Context()
-    state = scan_path(directory, ctx)
+# Writes to a temporary file in the same directory and renames it, so readers never see a partial file
+def write_file_atomically(path: str, content: str) -> None:
+    path = os.path.abspath(path)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+# Size of the object store and index, used to guess how long a repo that hasn't been probed before will take
+def git_repo_size(repo: GitRepo) -> int:
+    size = 0
+    try:
+        size += os.stat(os.path.join(repo.git_dir, 'index')).st_size
+        with os.scandir(os.path.join(repo.common_dir, 'objects', 'pack')) as it:
+            for entry in it:
+                if entry.name.endswith('.pack'):
+                    size += entry.stat().st_size
+    except OSError:
+        pass
+    return size
+
+def load_durations(path: str) -> dict[str, float]:
+    try:
+        with open(path, 'r') as f:
+            durations = json.load(f)
+        assert_type(durations, dict, 'durations')
+    except FileNotFoundError:
+        return {}
+    except (json.decoder.JSONDecodeError, AssertionError) as e:
+        log_warning('failed to load ' + path + ': ' + str(e))
+        return {}
+    result = {}
+    for repo_path, seconds in durations.items():
+        if isinstance(seconds, (int, float)) and not isinstance(seconds, bool):
+            result[repo_path] = float(seconds)
+        else:
+            log_warning('ignoring duration of ' + repo_path + ' in ' + path + ': ' + repr(seconds) + ' is not a number')
+    return result
+
+# Probes the Git repos queued while scanning on a thread pool. They're started longest expected first (based on how
+# long they took last time, or their size if they're new) so one huge repo doesn't start last and hold up the scan.
+# Returns the paths of repos that failed to be probed, which should be scanned as something else (see
+# rescan_failed_git_repos())
+def probe_git_repos(ctx: Context, jobs: int, durations_path: str) -> set[str]:
+    repos: list[GitRepo] = ctx.git_queue or []
+    ctx.git_queue = None
+    durations = load_durations(durations_path)
+    keys = {repo.path: os.path.realpath(repo.path) for repo in repos}
+    sizes = {repo.path: git_repo_size(repo) for repo in repos}
+    known = [repo for repo in repos if keys[repo.path] in durations]
+    known_size = sum(sizes[repo.path] for repo in known)
+    # Seconds per byte, defaulting to about a second per gigabyte
+    rate = sum(durations[keys[repo.path]] for repo in known) / known_size if known_size else 1e-9
+    expected = {repo.path: durations.get(keys[repo.path], sizes[repo.path] * rate) for repo in repos}
+    repos.sort(key=lambda repo: expected[repo.path], reverse=True)
+
+    def probe(repo: GitRepo) -> Optional[float]:
+        start = time.monotonic()
+        try:
+            repo.probe()
+        except AssertionError as e:
+            log('Failed to scan ' + repo.path + ' as a Git repo: ' + str(e))
+            return None
+        return time.monotonic() - start
+
+    start = time.monotonic()
+    # The executor starts jobs in the order they're submitted
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        taken = list(pool.map(probe, repos))
+    ctx.makespan_seconds = time.monotonic() - start
+    succeeded = [seconds for seconds in taken if seconds is not None]
+    ctx.ideal_makespan_seconds = max([sum(succeeded) / jobs] + succeeded)
+    log('Probed ' + str(len(repos)) + ' Git repos in ' + '%.3f' % ctx.makespan_seconds + 's, ideal is ' +
+        '%.3f' % ctx.ideal_makespan_seconds + 's')
+    failed = set()
+    for repo, seconds in zip(repos, taken):
+        if seconds is None:
+            failed.add(repo.path)
+            continue
+        repo.count()
+        durations[keys[repo.path]] = seconds
+    # Forget repos in the part of the tree this scan covered that weren't found, so deleted and moved repos don't stay
+    # in the file forever
+    if ctx.root is not None:
+        root = os.path.realpath(ctx.root)
+        found = set(keys.values())
+        for path in list(durations):
+            if (
+                path not in found and
+                os.path.commonpath([root, path]) == root and
+                (ctx.shard is None or shard_of(path, root, ctx.shard[1]) == ctx.shard[0])
+            ):
+                del durations[path]
+    os.makedirs(os.path.dirname(durations_path), exist_ok=True)
+    write_file_atomically(durations_path, json.dumps(durations, indent=1, sort_keys=True) + '\n')
+    return failed
+
+# Replaces Git repos that failed to be probed in parallel with what scan_path() would have found if they had been
+# probed as they were found
+def rescan_failed_git_repos(scanned: Any, failed: set[str], ctx: Context) -> Any:
+    if isinstance(scanned, GitRepo) and scanned.path in failed:
+        return scan_path(scanned.path, ctx, [MercurialRepo, Directory, File])
+    if isinstance(scanned, Directory):
+        contents = scanned.contents
+        scanned.contents = {}
+        scanned.contains_code_repo = False
+        vars(scanned).pop('contains_problem_repo', None)
+        for name, sub in contents.items():
+            scanned.add(name, rescan_failed_git_repos(sub, failed, ctx))
+    return scanned
+
+def metrics_label(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+# Atomically writes scan results in the OpenMetrics text format, for use with node_exporter's textfile collector
+def write_metrics_file(path: str, root: str, ctx: Context, scan_seconds: float) -> None:
+    root_label = 'root=' + metrics_label(root)
+    lines = []
+    def gauge(name: str, description: str, samples: list[tuple[str, float]]):
+        lines.append('# TYPE repo_manager_' + name + ' gauge')
+        lines.append('# HELP repo_manager_' + name + ' ' + description)
+        for labels, value in samples:
+            lines.append('repo_manager_' + name + '{' + labels + '} ' + str(value))
+    gauge('repos', 'Number of repos with a given problem state found by the last scan', [
+        (root_label + ',state="clean"', ctx.clean_repos),
+        (root_label + ',state="problem"', ctx.problem_repos),
+        (root_label + ',state="dirty"', ctx.dirty_repos),
+        (root_label + ',state="unsynced"', ctx.unsynced_repos),
+        (root_label + ',state="no_remote"', ctx.no_remote_repos),
+    ])
+    gauge('repos_by_vcs', 'Number of repos of each version control system found by the last scan', [
+        (root_label + ',vcs="git"', ctx.git_repos),
+        (root_label + ',vcs="mercurial"', ctx.mercurial_repos),
+    ])
+    gauge('scan_duration_seconds', 'Wall time of the last scan', [(root_label, scan_seconds)])
+    gauge('scan_subprocesses', 'Number of subprocesses spawned by the last scan', [(root_label, ctx.subprocesses)])
+    gauge('scan_fast_status_repos', 'Number of Git repos the last scan found clean without running git status', [
+        (root_label, ctx.fast_status_repos),
+    ])
+    gauge('scan_phase_duration_seconds', 'Time spent in each kind of subprocess during the last scan', [
+        (root_label + ',phase=' + metrics_label(phase), seconds)
+        for phase, seconds in sorted(ctx.phase_seconds.items())
+    ])
+    if ctx.makespan_seconds is not None and ctx.ideal_makespan_seconds is not None:
+        gauge('scan_makespan_seconds', 'Wall time the last scan spent probing Git repos in parallel', [
+            (root_label, ctx.makespan_seconds),
+        ])
+        gauge('scan_ideal_makespan_seconds', 'Lower bound on the time probing Git repos could have taken', [
+            (root_label, ctx.ideal_makespan_seconds),
+        ])
+    lines.append('# EOF')
+    # The temporary file does not end in .prom so node_exporter ignores it
+    write_file_atomically(path, '\n'.join(lines) + '\n')
+    log('Wrote metrics to ' + path)
+
+def print_scan_result(args, directory: str, state: Any, ctx: Context) -> None:
     color = not args.no_color
-    print(directory + ': ' + state.__str__(color=color))
-    print()
+    if not args.summary:
+        sys.stdout.write(directory + ': ')
+        if isinstance(state, Directory):
+            state.write(sys.stdout, color=color, problems_only=args.problems_only)
+        else:
+            sys.stdout.write(state.__str__(color=color))
+        print()
+        print()
     print(style_if(str(ctx.clean_repos), '1;32', color) + ' clean repos, ', end='')
     if ctx.problem_repos:
         print(style_if(str(ctx.problem_repos), '1;31', color) + ' dirty repos')
     else:
         print(style_if('No dirty repos', '1;32', color))
 
+def parse_shard(value: str) -> tuple[int, int]:
+    match = re.fullmatch(r'(\d+)/(\d+)', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError('shard must be in the form i/N with 1 <= i <= N')
+    return int(match.group(1)), int(match.group(2))
+
+def scan_command(args) -> None:
+    directory = get_directory_from_args(args, 'directory')
+    ctx = Context()
+    ctx.root = directory
+    ctx.shard = args.shard
+    ctx.fast_status = args.fast_status
+    # Whether repos are clean is always needed for the totals, but the summary doesn't show why they're not
+    if args.summary and not args.metrics_file and not args.save:
+        ctx.git_fields = ['working_tree_clean']
+    else:
+        ctx.git_fields = ['working_tree_clean', 'remotes', 'synced_with_remote']
+    if args.jobs < 1:
+        raise RuntimeError('--jobs must be at least 1')
+    if args.jobs > 1:
+        ctx.git_queue = []
+    start = time.monotonic()
+    state = scan_path(directory, ctx)
+    if ctx.git_queue is not None:
+        failed = probe_git_repos(ctx, args.jobs, os.path.abspath(os.path.expanduser(args.durations_file)))
+        if failed:
+            state = rescan_failed_git_repos(state, failed, ctx)
+    scan_seconds = time.monotonic() - start
+    if args.metrics_file:
+        write_metrics_file(args.metrics_file, directory, ctx, scan_seconds)
+    if args.save:
+        index, count = ctx.shard if ctx.shard is not None else (1, 1)
+        with open(args.save, 'w') as f:
+            json.dump({
+                'root': directory,
+                'shard': [index, count],
+                'scan_seconds': scan_seconds,
+                'context': ctx.to_json(),
+                'state': state.to_json(),
+            }, f)
+        log('Saved scan result to ' + args.save)
+    print_scan_result(args, directory, state, ctx)
+    if ctx.makespan_seconds is not None and ctx.ideal_makespan_seconds is not None:
+        print('Probed Git repos in ' + '%.2f' % ctx.makespan_seconds + 's with ' + str(args.jobs) + ' jobs (ideal ' +
+            '%.2f' % ctx.ideal_makespan_seconds + 's)')
+
+def merge_command(args) -> None:
+    ctx = Context()
+    state: Any = None
+    root: Optional[str] = None
+    shards: set[int] = set()
+    shard_count: Optional[int] = None
+    scan_seconds = 0.0
+    for path in args.results:
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            index, count = data['shard']
+            shard_root: str = data['root']
+            shard_seconds: float = data['scan_seconds']
+            shard_ctx = Context()
+            shard_ctx.add_json(data['context'])
+            scanned = scanned_from_json(data['state'])
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError, KeyError, TypeError, ValueError, AttributeError):
+            raise RuntimeError(path + ' is not a scan result')
+        # Shards may have been scanned with the root mounted in different places (the tree only uses relative names),
+        # so the first shard's root is shown
+        if shard_count is not None and count != shard_count:
+            raise RuntimeError(path + ' is not a shard of the same scan as ' + args.results[0])
+        if index in shards:
+            raise RuntimeError(path + ' contains shard ' + str(index) + '/' + str(count) + ' which was already loaded')
+        if root is None:
+            root = shard_root
+        shard_count = count
+        shards.add(index)
+        # Shards are scanned in parallel, so the slowest one determines the scan time
+        scan_seconds = max(scan_seconds, shard_seconds)
+        ctx.add_json(shard_ctx.to_json())
+        state = scanned if state is None else merge_scanned(state, scanned)
+    assert root is not None and shard_count is not None
+    missing = [str(i) for i in range(1, shard_count + 1) if i not in shards]
+    if missing:
+        raise RuntimeError('missing shard(s) ' + ', '.join(missing) + ' of ' + str(shard_count))
+    if args.metrics_file:
+        write_metrics_file(args.metrics_file, root, ctx, scan_seconds)
+    print_scan_result(args, root, state, ctx)
+
 def default_remote_url(remotes: dict[str, str]) -> str:
     if len(remotes) == 0:
         raise RuntimeError('No remotes')
@@ -246,86 +1179,6 @@ def default_remote_url(remotes: dict[str, str]) -> str:
 def name_from_git_url(url: str) -> str:
     return url.rsplit('.', 1)[0].rsplit('/', 1)[-1]
 
-def setup_repo_with_remotes(repo_dir: str, remotes: dict[str, str]):
-    preexisting = os.path.exists(repo_dir)
-    if not preexisting:
-        parent = os.path.dirname(repo_dir)
-        assert os.path.exists(parent), parent + ' does not exist'
-        remote_url = default_remote_url(remotes)
-        log('Cloning ' + remote_url + ' into ' + repo_dir)
-        Run(['git', 'clone', remote_url, repo_dir], passthrough=True, raise_on_fail=True)
-    parsed = GitRepo(repo_dir, Context())
-    for name, url in remotes.items():
-        if name not in parsed.remotes or url != parsed.remotes[name]:
-            if name in parsed.remotes:
-                log('Need to remove remote ' + name + ' with url ' + parsed.remotes[name] + ' so it can be replaced with ' + url)
-                Run(['git', 'remote', 'remove', name], path=repo_dir, raise_on_fail=True)
-            Run(['git', 'remote', 'add', name, url], path=repo_dir, raise_on_fail=True)
-        else:
-            log(repo_dir + ' already has remote ' + name + ' with url ' + url)
-    if preexisting and not parsed.is_problem():
-        Run(['git', 'pull'], passthrough=True, raise_on_fail=False)
-    log(repo_dir + ' has been set up with ' + str(len(remotes.items())) + ' remotes')
-
-def setup_repo_exclude(repo_dir: str, exclude: list[str]):
-    path = os.path.join(repo_dir, '.git', 'info', 'exclude')
-    with open(path, 'r') as f:
-        original = f.read()
-    section_start = '# <repo-manager>'
-    section_end = '# </repo-manager>'
-    # list of non-repo-manager bits of the exclude file
-    sections = re.split(re.escape(section_start) + r'.*?' + re.escape(section_end), original, flags=re.DOTALL)
-    if len(exclude) > 0:
-        to_add = [section_start] + exclude + [section_end]
-        if len(sections) == 1:
-            if not sections[0].endswith('\n\n'):
-                to_add.insert(0, '')
-            if not sections[0].endswith('\n'):
-                to_add.insert(0, '')
-            to_add.append('')
-        sections.insert(1, '\n'.join(to_add))
-    result = ''.join(sections)
-    if not result.endswith('\n'):
-        result += '\n'
-    if result != original:
-        log('Exclude file updated')
-        with open(path, 'w') as f:
-            f.write(result)
-    else:
-        log('Exclude file unchanged')
-
-def create_symlink(target: str, link: str):
-    target = os.path.abspath(target)
-    if os.path.exists(link):
-        if os.path.islink(link):
-            if os.path.abspath(os.readlink(link)) == target:
-                log('Leaving ' + link + ' unchanged')
-                return
-            else:
-                log('Removing old link from ' + link + ' to ' + os.readlink(link))
-                os.remove(link)
-        else:
-            raise RuntimeError(link + ' already exists and is not a symlink')
-    log('Linking ' + link + ' to ' + target)
-    os.symlink(target, link)
-
-def symlink_all(target_dir: str, link_dir: str) -> list[str]:
-    result = []
-    for item in os.listdir(target_dir):
-        if not item.startswith('.'):
-            create_symlink(os.path.join(target_dir, item), os.path.join(link_dir, item))
-            result.append(item)
-    return result
-
-def remove_dead_symlinks(link_dir: str):
-    for item in os.listdir(link_dir):
-        item_path = os.path.join(link_dir, item)
-        if os.path.islink(item_path):
-            target = os.readlink(item_path)
-            if not os.path.exists(target):
-                log('Removing broken symlink ' + item_path + ' (was pointing to ' + target + ')')
-                os.remove(item_path)
-
 def assert_type(value: Any, expected_type: Any, value_name: str):
     assert isinstance(value, expected_type), (
         str(value_name) + ' is type ' + str(type(value)) + ' instead of ' + str(expected_type)
@@ -411,6 +1264,141 @@ class ConfigDb:
             else:
                 log_warning(path + ' is not a directory')
 
+# Changes setup makes to a repo. They're all worked out before any are made, so they can be shown with --dry-run.
+class SetupPlan:
+    def __init__(self) -> None:
+        # Arguments, working directory, if output is passed through and if failing is an error
+        self.commands: list[tuple[list[str], Optional[str], bool, bool]] = []
+        # Links to remove and what they pointed to
+        self.unlinks: list[tuple[str, str]] = []
+        # Targets and the links to create pointing to them
+        self.links: list[tuple[str, str]] = []
+        # Path, original contents and new contents of the exclude file
+        self.exclude: Optional[tuple[str, str, str]] = None
+
+    def is_empty(self) -> bool:
+        return not self.commands and not self.unlinks and not self.links and self.exclude is None
+
+    def describe(self) -> list[str]:
+        result = []
+        for arg_list, path, _, _ in self.commands:
+            result.append('run `' + ' '.join(arg_list) + '`' + (' in ' + path if path else ''))
+        for link, target in self.unlinks:
+            result.append('remove link ' + link + ' (pointing to ' + target + ')')
+        for target, link in self.links:
+            result.append('link ' + link + ' to ' + target)
+        if self.exclude is not None:
+            path, original, updated = self.exclude
+            diff = difflib.unified_diff(original.splitlines(), updated.splitlines(), lineterm='', n=0)
+            result.append('update ' + path + ':\n' + '\n'.join(list(diff)[2:]))
+        return result
+
+    def apply(self) -> None:
+        for arg_list, path, passthrough, raise_on_fail in self.commands:
+            Run(arg_list, path=path, passthrough=passthrough, raise_on_fail=raise_on_fail)
+        for link, target in self.unlinks:
+            log('Removing link ' + link + ' (was pointing to ' + target + ')')
+            os.remove(link)
+        for target, link in self.links:
+            log('Linking ' + link + ' to ' + target)
+            os.symlink(target, link)
+        if self.exclude is not None:
+            path, _, updated = self.exclude
+            log('Updating ' + path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_file_atomically(path, updated)
+
+def plan_repo_remotes(plan: SetupPlan, repo_dir: str, remotes: dict[str, str]):
+    if os.path.exists(repo_dir):
+        parsed = GitRepo(repo_dir, Context())
+        current = parsed.remotes
+        can_pull = not parsed.is_problem()
+    else:
+        parent = os.path.dirname(repo_dir)
+        assert os.path.exists(parent), parent + ' does not exist'
+        remote_url = default_remote_url(remotes)
+        plan.commands.append((['git', 'clone', remote_url, repo_dir], None, True, True))
+        current = {'origin': remote_url}
+        can_pull = False
+    for name, url in remotes.items():
+        if name not in current or url != current[name]:
+            if name in current:
+                log('Need to remove remote ' + name + ' with url ' + current[name] + ' so it can be replaced with ' + url)
+                plan.commands.append((['git', 'remote', 'remove', name], repo_dir, False, True))
+            plan.commands.append((['git', 'remote', 'add', name, url], repo_dir, False, True))
+        else:
+            log(repo_dir + ' already has remote ' + name + ' with url ' + url)
+    if can_pull:
+        plan.commands.append((['git', 'pull'], repo_dir, True, False))
+
+def updated_exclude(original: str, exclude: list[str]) -> str:
+    section_start = '# <repo-manager>'
+    section_end = '# </repo-manager>'
+    # list of non-repo-manager bits of the exclude file
+    sections = re.split(re.escape(section_start) + r'.*?' + re.escape(section_end), original, flags=re.DOTALL)
+    if len(exclude) > 0:
+        to_add = [section_start] + exclude + [section_end]
+        if len(sections) == 1:
+            if not sections[0].endswith('\n\n'):
+                to_add.insert(0, '')
+            if not sections[0].endswith('\n'):
+                to_add.insert(0, '')
+            to_add.append('')
+        sections.insert(1, '\n'.join(to_add))
+    result = ''.join(sections)
+    if not result.endswith('\n'):
+        result += '\n'
+    return result
+
+# Plans linking everything in the config directory into the repo, removing dead links and updating the exclude file.
+# Each directory is only listed once, and a repo that hasn't been cloned yet is treated as empty.
+def plan_repo_files(plan: SetupPlan, repo_dir: str, config: RepoConfig):
+    try:
+        with os.scandir(repo_dir) as it:
+            existing = {entry.name: entry for entry in it}
+    except FileNotFoundError:
+        existing = {}
+    exclude = list(config.exclude)
+    linked = set()
+    if config.symlink_dir is not None:
+        with os.scandir(config.symlink_dir) as it:
+            # Sorted so the exclude file and plan don't depend on the order the filesystem lists files in
+            items = sorted(entry.name for entry in it if not entry.name.startswith('.'))
+        for item in items:
+            target = os.path.abspath(os.path.join(config.symlink_dir, item))
+            link = os.path.join(repo_dir, item)
+            linked.add(item)
+            exclude.append(item)
+            entry = existing.get(item)
+            if entry is None:
+                plan.links.append((target, link))
+            elif not entry.is_symlink():
+                raise RuntimeError(link + ' already exists and is not a symlink')
+            else:
+                old_target = os.readlink(link)
+                if os.path.normpath(os.path.join(repo_dir, old_target)) == target:
+                    log('Leaving ' + link + ' unchanged')
+                else:
+                    plan.unlinks.append((link, old_target))
+                    plan.links.append((target, link))
+    for item, entry in existing.items():
+        if item not in linked and entry.is_symlink():
+            target = os.readlink(entry.path)
+            if not os.path.exists(os.path.join(repo_dir, target)):
+                plan.unlinks.append((entry.path, target))
+    dirs = find_git_dirs(repo_dir)
+    path = os.path.join(dirs[1] if dirs else os.path.join(repo_dir, '.git'), 'info', 'exclude')
+    try:
+        with open(path, 'r') as f:
+            original = f.read()
+    except FileNotFoundError:
+        original = ''
+    updated = updated_exclude(original, exclude)
+    if updated != original:
+        plan.exclude = (path, original, updated)
+    else:
+        log('Exclude file unchanged')
+
 def setup_command(args) -> None:
     repo_dir = os.path.abspath(args.target)
     parent_dir = os.path.dirname(repo_dir)
@@ -424,12 +1412,24 @@ def setup_command(args) -> None:
     config = db.repos.get(repo_name)
     if config is None:
         raise RuntimeError(style_if(repo_name + ' repository is not known', '1;31', color))
-    setup_repo_with_remotes(repo_dir, config.remotes)
-    exclude = config.exclude
-    if config.symlink_dir is not None:
-        exclude += symlink_all(config.symlink_dir, repo_dir)
-    remove_dead_symlinks(repo_dir)
-    setup_repo_exclude(repo_dir, exclude)
+    preexisting = os.path.exists(repo_dir)
+    plan = SetupPlan()
+    plan_repo_remotes(plan, repo_dir, config.remotes)
+    if preexisting or args.dry_run:
+        plan_repo_files(plan, repo_dir, config)
+    if args.dry_run:
+        if plan.is_empty():
+            print(style_if(repo_dir + ' is already set up', '1;32', color))
+        for change in plan.describe():
+            print('Would ' + change)
+        return
+    plan.apply()
+    if not preexisting:
+        # A new repo needs to be cloned before its files can be planned
+        plan = SetupPlan()
+        plan_repo_files(plan, repo_dir, config)
+        plan.apply()
+    log(repo_dir + ' has been set up with ' + str(len(config.remotes.items())) + ' remotes')
     print(style_if(repo_dir + ' set up successfully', '1;32', color))
 
 def fix_default_branch_command(args) -> None:
@@ -452,7 +1452,6 @@ def fix_default_branch_command(args) -> None:
         Run(['git', 'branch', '-u', default_upstream, default_local], path=repo.path, raise_on_fail=True)
 
 if __name__ == '__main__':
-    import argparse
     parser = argparse.ArgumentParser(description='Manage a directory containing git repos')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
     parser.add_argument('--no-color', action='store_true', help='disable colored output')
@@ -461,11 +1460,29 @@ if __name__ == '__main__':
     subparser = subparsers.add_parser('scan', help='Scan a directory and show the results')
     subparser.set_defaults(func=scan_command)
     subparser.add_argument('directory', nargs='?', type=str, help='directory to scan, default is current directory')
+    group = subparser.add_mutually_exclusive_group()
+    group.add_argument('--problems-only', action='store_true', help='only show repos with problems and the directories containing them')
+    group.add_argument('--summary', action='store_true', help='only show the total repo counts')
+    subparser.add_argument('--metrics-file', type=str, help='also write results and timings to this file in the OpenMetrics text format')
+    subparser.add_argument('--shard', type=parse_shard, help='only scan shard i of N (for example 2/4), to split a scan across machines')
+    subparser.add_argument('--fast-status', action='store_true', help='skip git status for repos whose index shows they are clean, falling back to git status when unsure')
+    subparser.add_argument('-j', '--jobs', type=int, default=1, help='number of Git repos to probe in parallel')
+    subparser.add_argument('--durations-file', type=str, default=default_durations_path, help='file used to remember how long each Git repo took to probe, so the slowest can be started first when using --jobs')
+    subparser.add_argument('--save', type=str, help='save the scan result to this file so it can be combined with the merge command')
+
+    subparser = subparsers.add_parser('merge', help='Combine scan results saved from each shard and show the results')
+    subparser.set_defaults(func=merge_command)
+    subparser.add_argument('results', nargs='+', type=str, help='files saved with scan --save')
+    group = subparser.add_mutually_exclusive_group()
+    group.add_argument('--problems-only', action='store_true', help='only show repos with problems and the directories containing them')
+    group.add_argument('--summary', action='store_true', help='only show the total repo counts')
+    subparser.add_argument('--metrics-file', type=str, help='also write results and timings to this file in the OpenMetrics text format')
 
     subparser = subparsers.add_parser('setup', help='Clone or set up a repo from configuration (see repo-json.md)')
     subparser.set_defaults(func=setup_command)
     subparser.add_argument('-c', '--config', nargs='+', default=[default_config_path], type=str, help='directory that contains a repo.json file, repo_list.json file or other configuration directories')
     subparser.add_argument('-r', '--repo', type=str, help='name of the repository')
+    subparser.add_argument('--dry-run', action='store_true', help='show what would be changed without changing anything')
     subparser.add_argument('target', type=str, help='directory of the repo to set up')
 
     subparser = subparsers.add_parser('fix-default-branch', help='Update and rename the local and remote default branch')
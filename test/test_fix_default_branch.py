@@ -97,3 +97,14 @@ class ScanReposIntegration(TestCase):
         self.assertEquals(default_upstream('downstream'), 'origin/abc')
         self.assertEquals(upstream_of_branch('downstream', 'xyz'), 'origin/abc')
 
+    def test_does_not_check_status(self) -> None:
+        init_test([
+            MkDir('upstream', [
+                InitRepo('main'),
+            ]),
+            'git clone upstream downstream',
+        ])
+        result = run_repo_manager(['-v', 'fix-default-branch', 'downstream'])
+        self.assertNotIn('Running `git status`', result)
+        self.assertNotIn('Running `git remote -v`', result)
+
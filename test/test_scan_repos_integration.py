@@ -1,5 +1,7 @@
-from unittest import TestCase
+from unittest import TestCase, mock
 import os
+import json
+import subprocess
 
 from integration_helpers import *
 
@@ -123,3 +125,364 @@ class ScanReposIntegration(TestCase):
         self.assertIn('bar: Directory without repos', result)
         self.assertIn('file2: File', result)
         self.assertNotIn('file1', result)
+
+    def test_detects_worktree(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                InitRepo(),
+                'git worktree add -b feature ../repo_a_feature',
+            ]),
+        ])
+        result = run_repo_manager(['scan', '.'])
+        self.assertIn('repo_a_feature⎧ Git worktree', result)
+        self.assertNotIn('file.txt', result)
+        self.assertIn('0 clean repos, 2 dirty repos', result)
+
+    def test_clean_worktree_shares_remotes(self) -> None:
+        init_test([
+            MkDir('source', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+            'git clone ./source/repo_a',
+            InDir('repo_a', [
+                'git worktree add --detach ../repo_a_detached',
+            ]),
+        ])
+        result = run_repo_manager(['scan', '.'])
+        self.assertIn('repo_a_detached: Clean Git worktree', result)
+        self.assertIn('2 clean repos', result)
+
+    def test_detects_submodule(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                InitRepo(),
+            ]),
+            MkDir('repo_b', [
+                InitRepo(),
+                'git -c protocol.file.allow=always submodule add ../repo_a sub',
+            ]),
+        ])
+        result = run_repo_manager(['scan', './repo_b/sub'])
+        self.assertIn('Clean Git submodule', result)
+        self.assertIn('1 clean repos, No dirty repos', result)
+
+    def test_problems_only_hides_clean_subtrees(self) -> None:
+        init_test([
+            MkDir('source', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+            MkDir('foo', [
+                'git clone ../source/repo_a repo_clean',
+                MkDir('bar', [
+                    'touch file1',
+                ]),
+                MkDir('repo_dirty', [
+                    InitRepo(),
+                    'echo xyz > new_file.txt',
+                ]),
+            ]),
+        ])
+        result = run_repo_manager(['scan', '--problems-only', '.'])
+        self.assertIn('repo_dirty⎧ Git repo', result)
+        self.assertIn('source: ', result)
+        self.assertNotIn('repo_clean', result)
+        self.assertNotIn('bar', result)
+        self.assertIn('1 clean repos, 2 dirty repos', result)
+
+    def test_summary_only_shows_counts(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                InitRepo(),
+            ]),
+        ])
+        result = run_repo_manager(['scan', '--summary', '.'])
+        self.assertNotIn('repo_a', result)
+        self.assertIn('0 clean repos, 1 dirty repos', result)
+
+    def test_writes_metrics_file(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                InitRepo(),
+                'echo xyz > new_file.txt',
+            ]),
+        ])
+        metrics_path = os.path.join(temp_dir_parent, 'repos.prom')
+        run_repo_manager(['scan', '--summary', '--metrics-file', metrics_path, '.'])
+        metrics = contents_of(metrics_path)
+        self.assertIn('repo_manager_repos{root="' + temp_dir_home + '",state="clean"} 0\n', metrics)
+        self.assertIn('repo_manager_repos{root="' + temp_dir_home + '",state="dirty"} 1\n', metrics)
+        self.assertIn('repo_manager_repos_by_vcs{root="' + temp_dir_home + '",vcs="git"} 1\n', metrics)
+        self.assertIn('repo_manager_scan_phase_duration_seconds{root="' + temp_dir_home + '",phase="git status"}', metrics)
+        self.assertTrue(metrics.endswith('# EOF\n'))
+        self.assertEqual(sorted(os.listdir(temp_dir_parent)), ['config', 'home', 'repos.prom'])
+
+    def test_merges_sharded_scans(self) -> None:
+        init_test([
+            MkDir('source', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+            'git clone ./source/repo_a repo_b',
+            MkDir('foo', [
+                MkDir('repo_c', [
+                    InitRepo(),
+                ]),
+                MkDir('repo_d', [
+                    InitRepo(),
+                ]),
+            ]),
+        ])
+        parts = [os.path.join(temp_dir_parent, 'part' + str(i) + '.json') for i in range(1, 4)]
+        shard_results = [
+            run_repo_manager(['scan', '--shard', str(i + 1) + '/3', '--save', part, '.'])
+            for i, part in enumerate(parts)
+        ]
+        self.assertTrue(any('Repo in another shard' in result for result in shard_results))
+        result = run_repo_manager(['merge'] + parts)
+        self.assertNotIn('another shard', result)
+        self.assertIn('repo_b: Clean Git repo', result)
+        self.assertIn('repo_c⎧ Git repo', result)
+        self.assertIn('repo_d⎧ Git repo', result)
+        self.assertIn('1 clean repos, 3 dirty repos', result)
+
+    def test_fast_status_skips_git_status_for_clean_repo(self) -> None:
+        init_test([
+            MkDir('source', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+            'git clone ./source/repo_a',
+            # Make sure no files are racily clean
+            'sleep 0.1',
+            'git -C repo_a update-index --refresh --force-write-index',
+        ])
+        result = run_repo_manager(['-v', 'scan', '--fast-status', './repo_a'])
+        self.assertIn('skipping git status', result)
+        self.assertNotIn('Running `git status`', result)
+        self.assertIn('Clean Git repo', result)
+        self.assertIn('1 clean repos, No dirty repos', result)
+
+    def test_fast_status_detects_changes(self) -> None:
+        init_test([
+            MkDir('source', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+            'git clone ./source/repo_a modified',
+            'git clone ./source/repo_a staged',
+            'git clone ./source/repo_a untracked',
+            'sleep 0.1',
+            'echo bar >> modified/file.txt',
+            'echo bar > staged/new_file.txt',
+            'git -C staged add new_file.txt',
+            'echo bar > untracked/new_file.txt',
+        ])
+        result = run_repo_manager(['scan', '--fast-status', '.'])
+        self.assertNotIn('Clean Git repo', result)
+        self.assertIn('0 clean repos, 4 dirty repos', result)
+
+    def test_fast_status_agrees_when_untracked_files_are_hidden(self) -> None:
+        init_test([
+            MkDir('source', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+            'git clone ./source/repo_a',
+            'git -C repo_a config status.showUntrackedFiles no',
+            'sleep 0.1',
+            'git -C repo_a update-index --refresh --force-write-index',
+        ])
+        normal = run_repo_manager(['scan', './repo_a'])
+        fast = run_repo_manager(['scan', '--fast-status', './repo_a'])
+        self.assertIn('0 clean repos, 1 dirty repos', normal)
+        self.assertIn('0 clean repos, 1 dirty repos', fast)
+
+    def test_fast_status_falls_back_when_git_config_is_redirected(self) -> None:
+        init_test([
+            MkDir('source', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+            'git clone ./source/repo_a',
+            'sleep 0.1',
+            'git -C repo_a update-index --refresh --force-write-index',
+        ])
+        global_config = os.path.join(temp_dir_parent, 'gitconfig')
+        with open(global_config, 'w') as f:
+            f.write('[status]\n\tshowUntrackedFiles = no\n')
+        with mock.patch.dict(os.environ, {'GIT_CONFIG_GLOBAL': global_config}):
+            result = run_repo_manager(['-v', 'scan', '--fast-status', './repo_a'])
+        self.assertIn('Running `git status`', result)
+        self.assertIn('0 clean repos, 1 dirty repos', result)
+
+    def test_summary_skips_remotes_of_dirty_repos(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                InitRepo(),
+                'echo xyz > new_file.txt',
+            ]),
+        ])
+        result = run_repo_manager(['-v', 'scan', '--summary', '.'])
+        self.assertNotIn('Running `git remote -v`', result)
+        self.assertIn('0 clean repos, 1 dirty repos', result)
+
+    def test_parallel_scan_starts_slowest_repo_first(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                InitRepo(),
+            ]),
+            MkDir('repo_b', [
+                InitRepo(),
+            ]),
+            MkDir('repo_c', [
+                InitRepo(),
+            ]),
+        ])
+        durations_path = os.path.join(temp_dir_parent, 'durations.json')
+        with open(durations_path, 'w') as f:
+            json.dump({
+                os.path.join(temp_dir_home, 'repo_a'): 0.5,
+                os.path.join(temp_dir_home, 'repo_b'): 0.01,
+                os.path.join(temp_dir_home, 'repo_c'): 1.0,
+            }, f)
+        result = run_repo_manager(['-v', 'scan', '-j', '2', '--durations-file', durations_path, '.'])
+        started = [line for line in result.text_no_color.split('\n') if line.startswith('Scanning Git repo at')]
+        self.assertEqual(len(started), 3)
+        self.assertTrue(started[-1].endswith('repo_b...'))
+        self.assertIn('0 clean repos, 3 dirty repos', result)
+        self.assertIn('with 2 jobs (ideal', result)
+        with open(durations_path, 'r') as f:
+            durations = json.load(f)
+        self.assertLess(durations[os.path.join(temp_dir_home, 'repo_c')], 1.0)
+
+    def test_separate_git_dir_is_not_submodule(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                'git init --separate-git-dir=../repo_a_git',
+            ]),
+        ])
+        result = run_repo_manager(['scan', './repo_a'])
+        self.assertIn('Git repo', result)
+        self.assertNotIn('submodule', result)
+
+    def test_unreadable_git_file_is_scanned_as_directory(self) -> None:
+        init_test([
+            MkDir('foo', [
+                'printf "\\xff\\xfe" > .git',
+            ]),
+            MkDir('repo_a', [
+                InitRepo(),
+            ]),
+        ])
+        result = run_repo_manager(['scan', '.'])
+        self.assertIn('foo: Directory without repos', result)
+
+    def test_merges_shards_scanned_from_different_mount_points(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                InitRepo(),
+            ]),
+            MkDir('repo_b', [
+                InitRepo(),
+            ]),
+            'ln -s ' + temp_dir_home + ' ' + temp_dir_parent + '/home_link',
+        ])
+        part_1 = os.path.join(temp_dir_parent, 'part1.json')
+        part_2 = os.path.join(temp_dir_parent, 'part2.json')
+        run_repo_manager(['scan', '--shard', '1/2', '--save', part_1, '.'])
+        run_repo_manager(['scan', '--shard', '2/2', '--save', part_2, temp_dir_parent + '/home_link'])
+        result = run_repo_manager(['merge', part_1, part_2])
+        self.assertIn(temp_dir_home + ': ', result)
+        self.assertIn('0 clean repos, 2 dirty repos', result)
+
+    def test_merge_rejects_invalid_result(self) -> None:
+        init_test([])
+        part = os.path.join(temp_dir_parent, 'part.json')
+        with open(part, 'w') as f:
+            f.write('{"shard": [1, 1]')
+        os.chdir(temp_dir_home)
+        result = subprocess.run(
+            ['python3', os.path.join(project_root(), 'repo-manager.py'), 'merge', part],
+            encoding='utf-8', capture_output=True)
+        self.assertEqual(result.stderr, 'Error: ' + part + ' is not a scan result\n')
+
+    def test_parallel_scan_falls_back_for_broken_repo(self) -> None:
+        init_test([
+            MkDir('broken', [
+                MkDir('.git', []),
+                'touch file1',
+            ]),
+            MkDir('repo_a', [
+                InitRepo(),
+            ]),
+        ])
+        durations_path = os.path.join(temp_dir_parent, 'durations.json')
+        result = run_repo_manager(['scan', '-j', '2', '--durations-file', durations_path, '.'])
+        self.assertIn('broken: Directory without repos', result)
+        self.assertIn('0 clean repos, 1 dirty repos', result)
+
+    def test_parallel_scan_loads_worktree_remotes_once(self) -> None:
+        init_test([
+            MkDir('source', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+            'git clone ./source/repo_a',
+            InDir('repo_a', [
+                'git worktree add --detach ../worktree_' + str(i) for i in range(4)
+            ]),
+        ])
+        durations_path = os.path.join(temp_dir_parent, 'durations.json')
+        result = run_repo_manager(['-v', 'scan', '-j', '4', '--durations-file', durations_path, '.'])
+        # Once for source/repo_a, and once for repo_a and all its worktrees
+        self.assertEqual(result.text_no_color.count('Running `git remote -v`'), 2)
+        self.assertIn('5 clean repos, 1 dirty repos', result)
+
+    def test_parallel_scan_ignores_invalid_durations(self) -> None:
+        init_test([
+            MkDir('repo_a', [
+                InitRepo(),
+            ]),
+            MkDir('repo_b', [
+                InitRepo(),
+            ]),
+        ])
+        durations_path = os.path.join(temp_dir_parent, 'durations.json')
+        with open(durations_path, 'w') as f:
+            json.dump({os.path.join(temp_dir_home, 'repo_a'): 'slow'}, f)
+        result = run_repo_manager(['scan', '-j', '2', '--durations-file', durations_path, '.'])
+        self.assertIn('ignoring duration of ' + os.path.join(temp_dir_home, 'repo_a'), result)
+        self.assertIn('0 clean repos, 2 dirty repos', result)
+
+    def test_parallel_scan_forgets_durations_of_missing_repos(self) -> None:
+        init_test([
+            MkDir('tree', [
+                MkDir('repo_a', [
+                    InitRepo(),
+                ]),
+            ]),
+        ])
+        durations_path = os.path.join(temp_dir_parent, 'durations.json')
+        elsewhere = os.path.join(temp_dir_parent, 'elsewhere')
+        with open(durations_path, 'w') as f:
+            json.dump({
+                os.path.join(temp_dir_home, 'tree', 'deleted'): 1.0,
+                os.path.join(temp_dir_home, 'tree_b'): 1.0,
+                elsewhere: 1.0,
+            }, f)
+        run_repo_manager(['scan', '-j', '2', '--durations-file', durations_path, './tree'])
+        with open(durations_path, 'r') as f:
+            durations = json.load(f)
+        self.assertEqual(
+            sorted(durations),
+            sorted([elsewhere, os.path.join(temp_dir_home, 'tree', 'repo_a'), os.path.join(temp_dir_home, 'tree_b')]))
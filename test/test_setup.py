@@ -0,0 +1,70 @@
+from unittest import TestCase
+import os
+import subprocess
+
+from integration_helpers import *
+
+class SetupIntegration(TestCase):
+    def tearDown(self) -> None:
+        clean_up_test()
+
+    def init_config(self, cloned: bool = True) -> None:
+        init_test(
+            home=[
+                MkDir('upstream', [
+                    InitRepo(),
+                ]),
+                # Cloning from repo-manager would show git's progress on stderr
+                'git clone upstream foo' if cloned else 'true',
+            ],
+            config=[
+                MkDir('foo', [
+                    'echo \'{"origin": "' + temp_dir_home + '/upstream", "exclude": ["*.o"]}\' > repo.json',
+                    'echo bar > extra.txt',
+                ]),
+            ],
+        )
+
+    def test_dry_run_changes_nothing(self) -> None:
+        self.init_config(cloned=False)
+        result = run_repo_manager(['setup', 'foo', '--dry-run', '-c', temp_dir_config])
+        self.assertIn('Would run `git clone ' + temp_dir_home + '/upstream', result)
+        self.assertIn('Would link ' + temp_dir_home + '/foo/extra.txt to ' + temp_dir_config + '/foo/extra.txt', result)
+        self.assertIn('+*.o', result)
+        self.assertFalse(os.path.exists(os.path.join(temp_dir_home, 'foo')))
+
+    def test_links_config_and_updates_exclude(self) -> None:
+        self.init_config()
+        result = run_repo_manager(['setup', 'foo', '-c', temp_dir_config])
+        self.assertIn('set up successfully', result)
+        link = os.path.join(temp_dir_home, 'foo', 'extra.txt')
+        self.assertEqual(os.readlink(link), os.path.join(temp_dir_config, 'foo', 'extra.txt'))
+        exclude = contents_of(os.path.join(temp_dir_home, 'foo', '.git', 'info', 'exclude'))
+        self.assertIn('# <repo-manager>\n*.o\nextra.txt\nrepo.json\n# </repo-manager>\n', exclude)
+
+    def test_dry_run_shows_dead_link_removal(self) -> None:
+        self.init_config()
+        run_repo_manager(['setup', 'foo', '-c', temp_dir_config])
+        dead_link = os.path.join(temp_dir_home, 'foo', 'dead')
+        os.symlink(os.path.join(temp_dir_parent, 'nonexistent'), dead_link)
+        result = run_repo_manager(['setup', 'foo', '--dry-run', '-c', temp_dir_config])
+        self.assertIn('Would remove link ' + dead_link, result)
+        self.assertNotIn('Would link', result)
+        self.assertNotIn('exclude', result)
+        self.assertTrue(os.path.islink(dead_link))
+        run_repo_manager(['setup', 'foo', '-c', temp_dir_config])
+        self.assertFalse(os.path.lexists(dead_link))
+
+    def test_conflict_is_reported_before_changing_remotes(self) -> None:
+        self.init_config()
+        os.remove(os.path.join(temp_dir_config, 'foo', 'repo.json'))
+        with open(os.path.join(temp_dir_config, 'foo', 'repo.json'), 'w') as f:
+            f.write('{"remotes": {"origin": "' + temp_dir_home + '/upstream", "other": "' + temp_dir_home + '/upstream"}}')
+        with open(os.path.join(temp_dir_home, 'foo', 'extra.txt'), 'w') as f:
+            f.write('not a link')
+        os.chdir(temp_dir_home)
+        result = subprocess.run(
+            ['python3', os.path.join(project_root(), 'repo-manager.py'), 'setup', 'foo', '-c', temp_dir_config],
+            encoding='utf-8', capture_output=True)
+        self.assertIn('extra.txt already exists and is not a symlink', result.stderr)
+        self.assertEqual(output_of('git -C foo remote'), 'origin')